@@ -5,11 +5,21 @@ import io
 import random
 import time
 import re
-import subprocess
+import html
+import hashlib
+import secrets
+import mmap
+import shutil
+from urllib.parse import quote
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib3.exceptions import ProtocolError, ReadTimeoutError
+from google.auth.transport.requests import AuthorizedSession
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload
 
 # ------------------------
 # 服务账号配置
@@ -27,7 +37,8 @@ except json.JSONDecodeError:
 
 SCOPES = ['https://www.googleapis.com/auth/drive.readonly']
 creds = service_account.Credentials.from_service_account_info(service_account_info, scopes=SCOPES)
-service = build('drive', 'v3', credentials=creds)
+# 使用客户端库自带的发现文档，避免启动时通过网络拉取
+service = build('drive', 'v3', credentials=creds, static_discovery=True, cache_discovery=False)
 
 # ------------------------
 # 支持多文件夹 ID
@@ -39,6 +50,49 @@ if not folder_ids_str:
 
 FOLDER_IDS = [fid.strip() for fid in folder_ids_str.split(",") if fid.strip()]
 
+# ------------------------
+# 并发下载配置
+# ------------------------
+DRIVE_CONCURRENCY = int(os.environ.get("DRIVE_CONCURRENCY", "10"))  # 同时下载的文件数
+DRIVE_SUBMIT_INTERVAL = 0.1  # 提交下载任务的间隔（秒），避免超过 Drive 的每用户 QPS 限制
+DOWNLOAD_BUFFER_SIZE = 1024 * 1024  # 流式写入磁盘时的缓冲区大小
+DOWNLOAD_TIMEOUT = (5, 60)  # 单个文件下载的（连接, 读取）超时（秒）
+
+# ------------------------
+# 平台 API 共享会话 (连接池 + keep-alive)
+# ------------------------
+MAX_RETRIES = 3
+
+class ApiRetry(Retry):
+    """
+    POST（创建部署、创建项目）不是幂等的：5xx 或读取超时时服务端可能已经处理了请求，
+    重放会产生重复的生产部署。因此 POST 只在连接失败（请求未发出）和 429 限流时重试。
+    """
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if method and method.upper() == "POST":
+            return status_code == 429 and bool(self.total)
+        return super().is_retry(method, status_code, has_retry_after)
+
+# 仅对限流和临时性服务端错误重试，并遵循服务端返回的 Retry-After；
+# POST 不在 allowed_methods 中，读取错误不会被重放，429 的处理见 ApiRetry
+HTTP_RETRY = ApiRetry(
+    total=MAX_RETRIES,
+    backoff_factor=0.5,
+    status_forcelist=[429, 500, 502, 503, 504],
+    allowed_methods=["GET", "PUT"],
+    respect_retry_after_header=True
+)
+
+SESSION = requests.Session()
+SESSION.headers.update({"User-Agent": "satellite-deployer"})
+SESSION.mount("https://", HTTPAdapter(pool_connections=32, pool_maxsize=64, max_retries=HTTP_RETRY))
+API_TIMEOUT = (5, 60)  # 平台 API 请求的（连接, 读取）超时（秒），避免请求挂起导致整个部署卡住
+
+# Drive 文件内容通过带授权的 requests 会话直接流式下载，所有下载线程共享连接池
+DRIVE_API_URL = "https://www.googleapis.com/drive/v3"
+DRIVE_SESSION = AuthorizedSession(creds)
+DRIVE_SESSION.mount("https://", HTTPAdapter(pool_maxsize=DRIVE_CONCURRENCY, max_retries=HTTP_RETRY))
+
 # ------------------------
 # 从 TXT 文件读取关键词
 # ------------------------
@@ -46,7 +100,8 @@ keywords = []
 keywords_file = "keywords.txt"
 if os.path.exists(keywords_file):
     with open(keywords_file, "r", encoding="utf-8") as f:
-        keywords = [line.strip() for line in f if line.strip()]
+        # 一次性读取后在 C 层按行切分，每行只 strip 一次
+        keywords = [line for line in map(str.strip, f.read().splitlines()) if line]
 
 if not keywords:
     print("⚠️ keywords.txt 中没有找到关键词，将使用原始文件名。")
@@ -56,7 +111,8 @@ if not keywords:
 # ------------------------
 processed_file_path = "processed_files.json"
 cache_file_path = "files_cache.json"
-CACHE_EXPIRY_HOURS = 24  # 缓存有效期（小时）
+CACHE_FULL_REFRESH_HOURS = 24  # 全量重新拉取文件列表的周期（小时），用于发现移入的文件并清理已删除或移出的文件
+CACHE_CLOCK_SKEW_SECONDS = 300  # 增量同步时向前多查的时间窗口，容忍本地与 Drive 的时钟偏差
 
 try:
     if os.path.exists(processed_file_path):
@@ -68,194 +124,414 @@ except (json.JSONDecodeError, IOError) as e:
     print(f"读取 {processed_file_path} 时出错: {e}。将从一个空的已处理文件列表开始。")
     processed_data = {"fileIds": []}
 
+def write_file_atomic(path, content):
+    """先写入临时文件再原子替换目标文件，进程中途被终止时不会留下只写了一半的状态文件。"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
 def get_cached_files():
-    """从缓存中读取文件列表，如果缓存过期则返回None。"""
+    """
+    读取文件列表缓存。缓存不存在、损坏或到了全量刷新周期时返回 None，
+    否则返回缓存数据，由调用方基于 modifiedTime 做增量同步。
+    """
     if os.path.exists(cache_file_path):
         try:
             with open(cache_file_path, "r") as f:
                 cache_data = json.load(f)
-                last_updated = cache_data.get("last_updated")
-                if last_updated and (time.time() - last_updated < CACHE_EXPIRY_HOURS * 3600):
-                    print("✅ 缓存未过期，正在从本地加载文件列表。")
-                    return cache_data.get("files", [])
-                else:
-                    print(f"⏳ 缓存已过期（上次更新超过 {CACHE_EXPIRY_HOURS} 小时），将重新拉取文件列表。")
+            last_updated = cache_data.get("last_updated")
+            last_full_sync = cache_data.get("last_full_sync", last_updated)
+            if last_updated and last_full_sync and (time.time() - last_full_sync < CACHE_FULL_REFRESH_HOURS * 3600):
+                print("✅ 已加载本地文件列表缓存，将只拉取有变动的文件。")
+                cache_data["last_full_sync"] = last_full_sync
+                return cache_data
+            else:
+                print(f"⏳ 距上次全量同步已超过 {CACHE_FULL_REFRESH_HOURS} 小时，将重新拉取完整文件列表。")
         except (json.JSONDecodeError, IOError) as e:
             print(f"读取 {cache_file_path} 时出错: {e}。将重新拉取文件列表。")
     return None
 
-def save_files_to_cache(files):
-    """将文件列表和当前时间戳保存到缓存文件。"""
+def save_files_to_cache(files, synced_at, full_synced_at):
+    """将文件列表以及本次同步和上次全量同步的时间戳保存到缓存文件。"""
     cache_data = {
-        "last_updated": time.time(),
+        "last_updated": synced_at,
+        "last_full_sync": full_synced_at,
         "files": files
     }
-    with open(cache_file_path, "w") as f:
-        json.dump(cache_data, f, indent=4)
+    write_file_atomic(cache_file_path, json.dumps(cache_data, separators=(",", ":")))
     print("💾 已将文件列表保存到本地缓存。")
 
 # ------------------------
 # 获取文件列表的函数 (已优化)
 # ------------------------
-def list_files(folder_id):
-    """列出指定 Google Drive 文件夹中的所有文件，支持分页。"""
-    all_the_files = []
-    page_token = None
-    query = f"'{folder_id}' in parents and (" \
+DRIVE_QUERY_FOLDER_LIMIT = 50  # 单个查询中合并的文件夹数量，避免查询字符串过长
+
+def build_list_request(folder_ids, page_token=None, modified_after=None):
+    """构造一次列出多个文件夹中 HTML/TXT/Google 文档的请求，可只列出某时间之后修改或上传的文件。"""
+    parents = " or ".join(f"'{folder_id}' in parents" for folder_id in folder_ids)
+    query = f"({parents}) and trashed=false and (" \
             "mimeType='text/html' or " \
             "mimeType='text/plain' or " \
             "mimeType='application/vnd.google-apps.document')"
-    try:
-        while True:
-            results = service.files().list(
-                q=query,
-                pageSize=1000,
-                fields="nextPageToken, files(id, name, mimeType)",
-                pageToken=page_token
-            ).execute()
-            items = results.get('files', [])
-            all_the_files.extend(items)
-            page_token = results.get('nextPageToken', None)
-            if page_token is None:
-                break
-        print(f"  - 在文件夹 {folder_id} 中总共找到 {len(all_the_files)} 个文件。")
-        return all_the_files
-    except Exception as e:
-        print(f"列出文件时发生错误: {e}")
-        return []
+    if modified_after is not None:
+        since = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(modified_after))
+        # 上传时保留原始修改时间的文件 modifiedTime 会早于上传时间，需要同时按 createdTime 查询
+        query += f" and (modifiedTime > '{since}' or createdTime > '{since}')"
+    return service.files().list(
+        q=query,
+        pageSize=1000,
+        fields="nextPageToken, files(id, name, mimeType, modifiedTime, md5Checksum, version)",
+        pageToken=page_token
+    )
+
+def list_files(folder_ids, modified_after=None):
+    """用一个合并查询列出多个 Google Drive 文件夹中的所有文件，支持分页。出错时抛出异常。"""
+    all_the_files = []
+    page_token = None
+    while True:
+        results = build_list_request(folder_ids, page_token, modified_after).execute(num_retries=MAX_RETRIES)
+        items = results.get('files', [])
+        all_the_files.extend(items)
+        page_token = results.get('nextPageToken', None)
+        if page_token is None:
+            break
+    print(f"  - 在 {len(folder_ids)} 个文件夹中总共找到 {len(all_the_files)} 个文件。")
+    return all_the_files
+
+def list_all_files(folder_ids, modified_after=None):
+    """
+    把所有文件夹合并进 "('a' in parents or 'b' in parents)" 查询，
+    请求次数只取决于文件总数（每页 1000 个），而不是文件夹数量。
+    返回 (文件列表, 是否所有查询都成功)；部分失败时列表不完整，调用方不应推进同步时间。
+    """
+    all_the_files = []
+    complete = True
+    # 同一文件夹只查询一次
+    unique_ids = list(dict.fromkeys(folder_ids))
+    for start in range(0, len(unique_ids), DRIVE_QUERY_FOLDER_LIMIT):
+        try:
+            all_the_files.extend(list_files(unique_ids[start:start + DRIVE_QUERY_FOLDER_LIMIT], modified_after))
+        except Exception as e:
+            print(f"列出文件时发生错误: {e}")
+            complete = False
+    return all_the_files, complete
 
 # ------------------------
 # 下载和生成 HTML
 # ------------------------
+def download_media(file_id, fh, export_mime_type=None):
+    """
+    用一次流式 GET 把 Drive 文件内容写入 fh；指定 export_mime_type 时导出 Google 文档。
+    相比 MediaIoBaseDownload 按块逐个请求，每个文件只需一次 HTTP 往返。
+    """
+    if export_mime_type:
+        url = f"{DRIVE_API_URL}/files/{file_id}/export"
+        params = {"mimeType": export_mime_type}
+    else:
+        url = f"{DRIVE_API_URL}/files/{file_id}"
+        params = {"alt": "media"}
+    for attempt in range(MAX_RETRIES + 1):
+        # 重试前清空已写入的部分内容，从头重新下载
+        fh.seek(0)
+        fh.truncate()
+        try:
+            with DRIVE_SESSION.get(url, params=params, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+                response.raise_for_status()
+                # 直接读取底层流时需要手动开启 gzip 解码
+                response.raw.decode_content = True
+                shutil.copyfileobj(response.raw, fh, length=DOWNLOAD_BUFFER_SIZE)
+            return
+        # 响应头之后的传输中断（连接重置、读取超时）不会被 HTTPAdapter 的重试覆盖，在这里整体重试
+        except (requests.ConnectionError, requests.Timeout, ProtocolError, ReadTimeoutError) as e:
+            if attempt == MAX_RETRIES:
+                raise
+            print(f"⚠️ 下载 {file_id} 时连接中断 ({e})，正在重试...")
+            time.sleep(0.5 * 2 ** attempt)
+
+PLAIN_TEXT_HTML_TEMPLATE = "<!DOCTYPE html><html><head><meta charset='utf-8'><title>{title}</title></head><body><pre>{body}</pre></body></html>"
+
+def wrap_text_as_html(text_content, title):
+    """把纯文本包装成一个最简单的 HTML 页面，并转义其中的 HTML 特殊字符。"""
+    return PLAIN_TEXT_HTML_TEMPLATE.format(title=html.escape(title), body=html.escape(text_content))
+
 def download_html_file(file_id, file_name):
     """下载一个 HTML 文件。"""
-    request = service.files().get_media(fileId=file_id)
-    fh = io.FileIO(file_name, 'wb')
-    downloader = MediaIoBaseDownload(fh, request)
-    done = False
-    while not done:
-        _, done = downloader.next_chunk()
+    with io.FileIO(file_name, 'wb') as fh:
+        download_media(file_id, fh)
     print(f"✅ 已下载 {file_name}")
 
 def download_txt_file(file_id, file_name, original_name):
-    """下载一个文本文件并将其转换为 HTML。"""
-    request = service.files().get_media(fileId=file_id)
+    """下载一个文本文件，如果内容还不是 HTML 则将其转换为 HTML。"""
+    # 内容可能需要包装，先下载到内存，判断后只写一次磁盘
     fh = io.BytesIO()
-    downloader = MediaIoBaseDownload(fh, request)
-    done = False
-    while not done:
-        _, done = downloader.next_chunk()
-    text_content = fh.getvalue().decode('utf-8')
-    
-    # 检查内容是否已经是HTML格式
-    is_html = text_content.strip().lower().startswith('<!doctype html') or text_content.strip().lower().startswith('<html')
-    
-    if is_html:
-        # 如果已经是HTML格式，直接保存
-        html_content = text_content
-    else:
-        # 如果不是HTML格式，则包装成HTML
-        html_content = f"<!DOCTYPE html><html><head><meta charset='utf-8'><title>{original_name}</title></head><body><pre>{text_content}</pre></body></html>"
-    
+    download_media(file_id, fh)
+    data = fh.getvalue()
+
+    # 检查内容是否已经是HTML格式（只检查开头部分）
+    if data[:256].lstrip().lower().startswith((b'<!doctype html', b'<html')):
+        with open(file_name, 'wb') as f:
+            f.write(data)
+        print(f"✅ TXT 内容已是 HTML，已直接保存: {file_name}")
+        return
+
+    # 如果不是HTML格式，则包装成HTML
     with open(file_name, 'w', encoding='utf-8') as f:
-        f.write(html_content)
+        f.write(wrap_text_as_html(data.decode('utf-8'), original_name))
     print(f"✅ TXT 已转换为 HTML: {file_name}")
 
 def export_google_doc(file_id, file_name):
     """将 Google 文档导出为 HTML。"""
-    request = service.files().export_media(fileId=file_id, mimeType='text/html')
-    fh = io.FileIO(file_name, 'wb')
-    downloader = MediaIoBaseDownload(fh, request)
-    done = False
-    while not done:
-        _, done = downloader.next_chunk()
+    with io.FileIO(file_name, 'wb') as fh:
+        download_media(file_id, fh, export_mime_type='text/html')
     print(f"✅ Google 文档已导出为 HTML: {file_name}")
 
+def download_drive_file(f, file_name):
+    """根据 MIME 类型下载或导出一个 Drive 文件。"""
+    if f['mimeType'] == 'text/html':
+        download_html_file(f['id'], file_name)
+    elif f['mimeType'] == 'text/plain':
+        download_txt_file(f['id'], file_name, f['name'])
+    else: # 'application/vnd.google-apps.document'
+        export_google_doc(f['id'], file_name)
+
 # ------------------------
 # 部署到目标平台
 # ------------------------
-def deploy_to_target(target):
-    """使用 Vercel 和 Netlify CLI 部署到指定的项目和站点。"""
+NETLIFY_API_URL = "https://api.netlify.com/api/v1"
+NETLIFY_POLL_INTERVAL = 2  # 轮询异步部署状态的间隔（秒）
+NETLIFY_POLL_TIMEOUT = 300  # 等待 Netlify 准备部署的最长时间（秒）
+VERCEL_API_URL = "https://api.vercel.com"
+UPLOAD_CONCURRENCY = 8  # 同时上传文件的线程数，共享 SESSION 的连接池
+UPLOAD_TIMEOUT = (5, 30)  # 单个文件上传的（连接, 读取）超时（秒）
+
+def upload_concurrently(upload_one, items):
+    """用线程池并发执行上传，任一文件上传失败时抛出其异常。"""
+    with ThreadPoolExecutor(max_workers=UPLOAD_CONCURRENCY) as executor:
+        for future in as_completed([executor.submit(upload_one, *item) for item in items]):
+            future.result()
+
+def list_site_files():
+    """返回需要部署的站点文件（当前目录下的所有 HTML 页面）。"""
+    # os.scandir 的 DirEntry 自带文件类型信息，无需为每个文件额外 stat
+    with os.scandir(".") as entries:
+        return sorted(e.name for e in entries if e.name.endswith(".html") and e.is_file(follow_symlinks=False))
+
+def sha1_of_file(path):
+    """计算文件的 SHA1 摘要，Netlify 和 Vercel 都用它判断文件是否已经上传过。"""
+    with open(path, "rb") as f:
+        # 空文件无法 mmap
+        if os.fstat(f.fileno()).st_size == 0:
+            return hashlib.sha1().hexdigest()
+        # 直接对页缓存做哈希，不把整个文件复制成 Python bytes 对象
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return hashlib.sha1(mm).hexdigest()
+
+def build_site_manifest():
+    """计算所有站点文件的 SHA1 清单，两个平台的部署共用同一份。"""
+    return {fname: sha1_of_file(fname) for fname in list_site_files()}
+
+def deploy_to_netlify(site_id, netlify_token, manifest):
+    """
+    通过 Netlify 文件摘要 API 部署：先提交所有文件的 SHA1 清单，
+    Netlify 只要求上传它尚未见过的文件，未变化的页面无需重新上传。
+    """
+    headers = {"Authorization": f"Bearer {netlify_token}"}
+    digests = {f"/{fname}": sha for fname, sha in manifest.items()}
+
+    # async=True 让 Netlify 在后台计算需要上传的文件，避免大站点触发 API 超时
+    response = SESSION.post(
+        f"{NETLIFY_API_URL}/sites/{site_id}/deploys",
+        headers=headers,
+        json={"files": digests, "async": True},
+        timeout=API_TIMEOUT
+    )
+    response.raise_for_status()
+    deploy = response.json()
+    deploy_id = deploy["id"]
+
+    deadline = time.time() + NETLIFY_POLL_TIMEOUT
+    while deploy.get("state") not in ("prepared", "ready", "error"):
+        if time.time() > deadline:
+            raise RuntimeError(f"等待 Netlify 部署 {deploy_id} 准备就绪超时")
+        time.sleep(NETLIFY_POLL_INTERVAL)
+        response = SESSION.get(f"{NETLIFY_API_URL}/deploys/{deploy_id}", headers=headers, timeout=API_TIMEOUT)
+        response.raise_for_status()
+        deploy = response.json()
+    if deploy["state"] == "error":
+        raise RuntimeError(deploy.get("error_message") or f"Netlify 部署 {deploy_id} 失败")
+
+    # 相同内容的文件只需上传一次
+    required = set(deploy.get("required") or [])
+    uploads = {}
+    for path, sha in digests.items():
+        if sha in required and sha not in uploads:
+            uploads[sha] = path
+
+    def upload_file(path):
+        with open(path[1:], "rb") as f:
+            data = f.read()
+        response = SESSION.put(
+            f"{NETLIFY_API_URL}/deploys/{deploy_id}/files{quote(path)}",
+            headers={**headers, "Content-Type": "application/octet-stream"},
+            data=data,
+            timeout=UPLOAD_TIMEOUT
+        )
+        response.raise_for_status()
+
+    upload_concurrently(upload_file, [(path,) for path in uploads.values()])
+    print(f"  - Netlify 需要上传 {len(uploads)} 个文件，其余 {len(digests) - len(uploads)} 个文件未变化已跳过。")
+
+def deploy_to_vercel(project_id, vercel_token, vercel_org_id, manifest):
+    """
+    通过 Vercel 部署 API 发布到生产环境：提交文件的 SHA1 清单，
+    Vercel 返回缺失的文件后只上传这些文件，再重新创建部署。
+    """
+    team_query = f"?teamId={vercel_org_id}" if vercel_org_id else ""
+    headers = {"Authorization": f"Bearer {vercel_token}"}
+    payload = {
+        "name": project_id,
+        "project": project_id,
+        "target": "production",
+        "projectSettings": {"framework": None},
+        "files": [
+            {"file": fname, "sha": sha, "size": os.path.getsize(fname)}
+            for fname, sha in manifest.items()
+        ]
+    }
+    deployments_url = f"{VERCEL_API_URL}/v13/deployments{team_query}"
+
+    response = SESSION.post(deployments_url, headers=headers, json=payload, timeout=API_TIMEOUT)
+    error = response.json().get("error", {}) if response.status_code == 400 else {}
+    if error.get("code") == "missing_files":
+        # 相同内容的文件只需上传一次
+        missing = set(error.get("missing") or [])
+        uploads = {}
+        for fname, sha in manifest.items():
+            if sha in missing and sha not in uploads:
+                uploads[sha] = fname
+
+        def upload_file(sha, fname):
+            with open(fname, "rb") as f:
+                data = f.read()
+            upload = SESSION.post(
+                f"{VERCEL_API_URL}/v2/files{team_query}",
+                headers={**headers, "Content-Type": "application/octet-stream", "x-vercel-digest": sha},
+                data=data,
+                timeout=UPLOAD_TIMEOUT
+            )
+            upload.raise_for_status()
+
+        upload_concurrently(upload_file, uploads.items())
+        print(f"  - Vercel 需要上传 {len(uploads)} 个文件，其余 {len(manifest) - len(uploads)} 个文件未变化已跳过。")
+        response = SESSION.post(deployments_url, headers=headers, json=payload, timeout=API_TIMEOUT)
+    response.raise_for_status()
+    deployment = response.json()
+    print(f"  - Vercel 部署地址: https://{deployment.get('url')}")
+
+def deploy_vercel_target(target, manifest):
+    """使用 Vercel 部署 API 部署到指定项目。"""
     print(f"🚀 正在部署到 Vercel 项目: {target['vercel_project_id']}")
-    vercel_command = [
-        "vercel", "--prod", "--yes",
-        "--token", os.environ.get("VERCEL_TOKEN"),
-        "--project", target["vercel_project_id"],
-        "--scope", os.environ.get("VERCEL_ORG_ID")
-    ]
     try:
-        subprocess.run(vercel_command, check=True)
+        deploy_to_vercel(
+            target["vercel_project_id"],
+            os.environ.get("VERCEL_TOKEN"),
+            os.environ.get("VERCEL_ORG_ID"),
+            manifest
+        )
         print("✅ Vercel 部署成功！")
-    except subprocess.CalledProcessError as e:
+    # 读取页面失败 (OSError) 或响应缺少字段 (KeyError) 也只影响当前平台，不中断整个运行
+    except (requests.exceptions.RequestException, ValueError, OSError, KeyError) as e:
         print(f"❌ Vercel 部署失败: {e}")
-        return
 
+def deploy_netlify_target(target, manifest):
+    """使用 Netlify 文件摘要 API 部署到指定站点。"""
     print(f"🚀 正在部署到 Netlify 站点: {target['netlify_site_id']}")
-    netlify_command = [
-        "netlify", "deploy", "--dir", ".", "--prod", "--site", target["netlify_site_id"]
-    ]
     try:
-        subprocess.run(netlify_command, check=True)
+        deploy_to_netlify(target["netlify_site_id"], os.environ.get("NETLIFY_TOKEN"), manifest)
         print("✅ Netlify 部署成功！")
-    except subprocess.CalledProcessError as e:
+    except (requests.exceptions.RequestException, RuntimeError, ValueError, OSError, KeyError) as e:
         print(f"❌ Netlify 部署失败: {e}")
 
+def deploy_to_target(target):
+    """
+    并发部署到指定的 Vercel 项目和 Netlify 站点。
+    两个平台的部署互不依赖，总耗时约等于较慢的一方。
+    """
+    manifest = build_site_manifest()
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [
+            executor.submit(deploy_vercel_target, target, manifest),
+            executor.submit(deploy_netlify_target, target, manifest)
+        ]
+        for future in as_completed(futures):
+            future.result()
+
 # ------------------------
 # 新增的 API 创建函数
 # ------------------------
-def create_new_target_api(vercel_token, netlify_token, vercel_org_id):
-    """
-    通过 API 创建新的 Vercel 和 Netlify 项目。
-    """
-    project_name = f"auto-site-{int(time.time())}"
-    
-    print("----------------------------------------------------------------------")
+def create_vercel_project(project_name, vercel_token, vercel_org_id):
+    """通过 API 创建新的 Vercel 项目，成功时返回项目 ID，失败返回 None。"""
     print(f"🚀 正在通过 API 创建新的 Vercel 项目: {project_name}")
-    print("----------------------------------------------------------------------")
 
-    # Vercel API 调用
-    vercel_url = f"https://api.vercel.com/v9/projects?{f'teamId={vercel_org_id}' if vercel_org_id else ''}"
-    vercel_headers = {
-        "Authorization": f"Bearer {vercel_token}",
-        "Content-Type": "application/json"
-    }
+    team_query = f"?teamId={vercel_org_id}" if vercel_org_id else ""
+    vercel_url = f"{VERCEL_API_URL}/v9/projects{team_query}"
+    vercel_headers = {"Authorization": f"Bearer {vercel_token}"}
     vercel_payload = {
         "name": project_name,
         "framework": None,
         "git": None
     }
     try:
-        response = requests.post(vercel_url, headers=vercel_headers, json=vercel_payload)
+        response = SESSION.post(vercel_url, headers=vercel_headers, json=vercel_payload, timeout=API_TIMEOUT)
         response.raise_for_status()
         vercel_data = response.json()
         new_vercel_project_id = vercel_data.get('id')
         print(f"✅ Vercel 项目创建成功，ID: {new_vercel_project_id}")
+        return new_vercel_project_id
     except requests.exceptions.RequestException as e:
         print(f"❌ Vercel API 调用失败: {e}")
         return None
 
-    print("----------------------------------------------------------------------")
+def create_netlify_site(project_name, netlify_token):
+    """通过 API 创建新的 Netlify 站点，成功时返回站点 ID，失败返回 None。"""
     print(f"🚀 正在通过 API 创建新的 Netlify 站点: {project_name}")
-    print("----------------------------------------------------------------------")
 
-    # Netlify API 调用
-    netlify_url = "https://api.netlify.com/api/v1/sites"
-    netlify_headers = {
-        "Authorization": f"Bearer {netlify_token}",
-        "Content-Type": "application/json"
-    }
+    netlify_url = f"{NETLIFY_API_URL}/sites"
+    netlify_headers = {"Authorization": f"Bearer {netlify_token}"}
     netlify_payload = {
         "name": project_name
     }
     try:
-        response = requests.post(netlify_url, headers=netlify_headers, json=netlify_payload)
+        response = SESSION.post(netlify_url, headers=netlify_headers, json=netlify_payload, timeout=API_TIMEOUT)
         response.raise_for_status()
         netlify_data = response.json()
         new_netlify_site_id = netlify_data.get('site_id')
         print(f"✅ Netlify 站点创建成功，ID: {new_netlify_site_id}")
+        return new_netlify_site_id
     except requests.exceptions.RequestException as e:
         print(f"❌ Netlify API 调用失败: {e}")
         return None
+
+def create_new_target_api(vercel_token, netlify_token, vercel_org_id):
+    """
+    通过 API 创建新的 Vercel 和 Netlify 项目。
+    依次创建：Vercel 失败时直接返回，不会留下一个没有被记录的 Netlify 站点。
+    """
+    # 随机后缀避免同一秒内并发创建时项目名冲突
+    project_name = f"auto-site-{secrets.token_hex(6)}"
+
+    print("----------------------------------------------------------------------")
+    print(f"🚀 正在通过 API 创建新的部署目标: {project_name}")
+    print("----------------------------------------------------------------------")
+
+    new_vercel_project_id = create_vercel_project(project_name, vercel_token, vercel_org_id)
+    if not new_vercel_project_id:
+        return None
+
+    new_netlify_site_id = create_netlify_site(project_name, netlify_token)
+    if not new_netlify_site_id:
+        return None
     
     new_target = {
         "vercel_project_id": new_vercel_project_id,
@@ -264,33 +540,67 @@ def create_new_target_api(vercel_token, netlify_token, vercel_org_id):
     
     deploy_targets_file = "deploy_targets.json"
     try:
-        with open(deploy_targets_file, "r+") as f:
+        with open(deploy_targets_file, "r") as f:
             targets = json.load(f)
-            targets.append(new_target)
-            f.seek(0)
-            json.dump(targets, f, indent=4)
     except FileNotFoundError:
-        with open(deploy_targets_file, "w") as f:
-            json.dump([new_target], f, indent=4)
-            
+        targets = []
+    targets.append(new_target)
+    write_file_atomic(deploy_targets_file, json.dumps(targets, indent=4))
+
     print(f"\n✅ 已成功创建并保存新的部署目标到 {deploy_targets_file}！")
     return new_target
 
 # ------------------------
 # 主程序
 # ------------------------
-all_files = get_cached_files()
-
-if all_files is None:
-    all_files = []
-    print("⏳ 正在从 Google Drive 拉取所有文件列表...")
-    for folder_id in FOLDER_IDS:
-        print(f"📂 正在获取文件夹: {folder_id}")
-        files = list_files(folder_id)
-        all_files.extend(files)
-    save_files_to_cache(all_files)
-
-new_files = [f for f in all_files if f['id'] not in processed_data["fileIds"]]
+sync_started = time.time()
+cache_data = get_cached_files()
+
+if cache_data is None:
+    print(f"⏳ 正在从 Google Drive 拉取 {len(FOLDER_IDS)} 个文件夹的文件列表...")
+    all_files, listing_complete = list_all_files(FOLDER_IDS)
+    if listing_complete:
+        save_files_to_cache(all_files, sync_started, sync_started)
+    else:
+        # 列表不完整时保留旧缓存，下次运行重新全量拉取
+        print("⚠️ 部分文件夹拉取失败，本次不更新文件列表缓存。")
+else:
+    # 只拉取上次同步之后新增或修改过的文件，并按 ID 合并进缓存
+    print("⏳ 正在从 Google Drive 增量拉取自上次同步以来有变动的文件...")
+    changed_files, listing_complete = list_all_files(FOLDER_IDS, cache_data["last_updated"] - CACHE_CLOCK_SKEW_SECONDS)
+    files_by_id = {f['id']: f for f in cache_data.get("files", [])}
+    for f in changed_files:
+        files_by_id[f['id']] = f
+    all_files = list(files_by_id.values())
+    print(f"  - 增量同步发现 {len(changed_files)} 个新增或修改的文件。")
+    if listing_complete:
+        save_files_to_cache(all_files, sync_started, cache_data["last_full_sync"])
+    else:
+        # 保留上次的同步时间，下次运行会重新查询这段时间内的变动，不会漏掉文件
+        print("⚠️ 部分文件夹拉取失败，本次不推进增量同步时间。")
+        save_files_to_cache(all_files, cache_data["last_updated"], cache_data["last_full_sync"])
+
+# Drive 列表中已经带有 md5Checksum（Google 文档除外），内容与已处理文件完全相同的
+# 新文件无需再下载，避免为重复上传的内容生成重复页面
+# 已处理的 ID 列表随运行次数增长，用集合做成员判断
+processed_ids = set(processed_data["fileIds"])
+processed_md5s = {f['md5Checksum'] for f in all_files
+                  if f.get('md5Checksum') and f['id'] in processed_ids}
+new_files = []
+duplicate_count = 0
+for f in all_files:
+    if f['id'] in processed_ids:
+        continue
+    md5 = f.get('md5Checksum')
+    if md5:
+        if md5 in processed_md5s:
+            duplicate_count += 1
+            continue
+        processed_md5s.add(md5)
+    new_files.append(f)
+
+if duplicate_count:
+    print(f"⏭️ 跳过 {duplicate_count} 个与已有文件内容相同的文件。")
 
 if not new_files:
     print("✅ 没有新的文件需要处理。")
@@ -300,92 +610,162 @@ else:
     selected_files = random.sample(new_files, num_to_process)
     print(f"本次运行将处理 {len(selected_files)} 个文件。")
 
-    available_keywords = list(keywords)
+    available_keywords = deque(keywords)
     keywords_ran_out = False
 
+    # 先按顺序分配文件名（关键词按顺序消耗），再并发下载
+    # 并发下载时文件名必须互不相同，否则两个线程会同时写入（或失败时删除）同一个文件
+    jobs = []
+    used_names = set()
     for f in selected_files:
-        if available_keywords:
-            keyword = available_keywords.pop(0)
+        keyword = None
+        safe_name = None
+        while available_keywords:
+            keyword = available_keywords.popleft()
             safe_name = keyword + ".html"
-        else:
+            if safe_name not in used_names:
+                break
+            print(f"⚠️ 关键词 '{keyword}' 在 keywords.txt 中重复，已跳过。")
+            keyword = None
+            safe_name = None
+        if safe_name is None:
             if not keywords_ran_out:
                 print("⚠️ 关键词已用完，将使用原始文件名加随机后缀。")
                 keywords_ran_out = True
             
             base_name = os.path.splitext(f['name'])[0]
             sanitized_name = base_name.replace(" ", "-").replace("/", "-")
-            random_suffix = str(random.randint(1000, 9999))
-            safe_name = f"{sanitized_name}-{random_suffix}.html"
-
-        print(f"正在处理 '{f['name']}' -> '{safe_name}'")
-
-        if f['mimeType'] == 'text/html':
-            download_html_file(f['id'], safe_name)
-        elif f['mimeType'] == 'text/plain':
-            download_txt_file(f['id'], safe_name, f['name'])
-        else: # 'application/vnd.google-apps.document'
-            export_google_doc(f['id'], safe_name)
-
-        processed_data["fileIds"].append(f['id'])
-
-    with open(processed_file_path, "w") as f:
-        json.dump(processed_data, f, indent=4)
-    print(f"💾 已将 {len(selected_files)} 个新文件 ID 保存到 {processed_file_path}")
-
-    with open(keywords_file, "w", encoding="utf-8") as f:
-        for keyword in available_keywords:
-            f.write(keyword + "\n")
-    print(f"✅ 已用剩余的关键词更新 {keywords_file}")
+            while safe_name is None or safe_name in used_names:
+                random_suffix = str(random.randint(1000, 9999))
+                safe_name = f"{sanitized_name}-{random_suffix}.html"
+        used_names.add(safe_name)
+        jobs.append((f, safe_name, keyword))
+
+    print(f"⏳ 正在以 {DRIVE_CONCURRENCY} 个并发下载 {len(jobs)} 个文件...")
+    processed_count = 0
+    failed_keywords = []
+    with ThreadPoolExecutor(max_workers=DRIVE_CONCURRENCY) as executor:
+        futures = {}
+        for job_index, (f, safe_name, keyword) in enumerate(jobs):
+            print(f"正在处理 '{f['name']}' -> '{safe_name}'")
+            futures[executor.submit(download_drive_file, f, safe_name)] = (job_index, f, safe_name, keyword)
+            time.sleep(DRIVE_SUBMIT_INTERVAL)
+
+        # 单个文件失败（如 5xx）不影响其他文件，失败的文件下次运行会重新处理
+        for future in as_completed(futures):
+            job_index, f, safe_name, keyword = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                print(f"❌ 处理 '{f['name']}' 失败: {e}")
+                if os.path.exists(safe_name):
+                    os.remove(safe_name)
+                if keyword is not None:
+                    failed_keywords.append((job_index, keyword))
+                continue
+            processed_data["fileIds"].append(f['id'])
+            processed_count += 1
+
+    # 下载按完成顺序返回，失败的关键词按原来的顺序放回队首，keywords.txt 的顺序保持不变
+    failed_keywords.sort()
+    available_keywords.extendleft(reversed([keyword for _, keyword in failed_keywords]))
+
+    # 状态没有变化时（例如所有下载都失败）不重写文件
+    if processed_count:
+        write_file_atomic(processed_file_path, json.dumps(processed_data, separators=(",", ":")))
+        print(f"💾 已将 {processed_count} 个新文件 ID 保存到 {processed_file_path}")
+
+    if len(available_keywords) != len(keywords):
+        write_file_atomic(keywords_file, "".join(keyword + "\n" for keyword in available_keywords))
+        print(f"✅ 已用剩余的关键词更新 {keywords_file}")
 
 # ------------------------
 # 生成累积的站点地图
 # ------------------------
-existing_html_files = [f for f in os.listdir(".") if f.endswith(".html") and f != "index.html"]
-index_content = "<!DOCTYPE html><html><head><meta charset='utf-8'><title>Reading Glasses</title></head><body>\n"
-index_content += "<h1>Reading Glasses</h1>\n<ul>\n"
-for fname in sorted(existing_html_files):
-    index_content += f'<li><a href="{fname}">{fname}</a></li>\n'
-index_content += "</ul>\n</body></html>"
-
+# 站点地图页面的固定 HTML 骨架
+INDEX_TITLE = "Reading Glasses"
+INDEX_HEAD = (
+    f"<!DOCTYPE html><html><head><meta charset='utf-8'><title>{INDEX_TITLE}</title></head><body>\n"
+    f"<h1>{INDEX_TITLE}</h1>\n<ul>\n"
+)
+INDEX_TAIL = "</ul>\n</body></html>"
+# 站点地图和页面底部共用的单条链接模板
+LINK_ITEM_TEMPLATE = '<li><a href="{0}">{0}</a></li>'
+
+existing_html_files = [f for f in list_site_files() if f != "index.html"]
+
+# 逐行直接写入文件，不在内存中拼出整个页面
 with open("index.html", "w", encoding="utf-8") as f:
-    f.write(index_content)
+    f.write(INDEX_HEAD)
+    f.writelines(LINK_ITEM_TEMPLATE.format(fname) + "\n" for fname in existing_html_files)
+    f.write(INDEX_TAIL)
 print("✅ 已生成 index.html (完整站点地图)")
 
 # ------------------------
 # 在每个页面底部添加随机内部链接 (已优化，不会累积)
 # ------------------------
-all_html_files = [f for f in os.listdir(".") if f.endswith(".html") and f != "index.html"]
-
-for fname in all_html_files:
+# 预编译正则表达式，避免每个页面重复解析
+# re.DOTALL 允许 '.' 匹配换行符，re.IGNORECASE 忽略大小写
+FOOTER_RE = re.compile(r"<footer>.*?</footer>", re.DOTALL | re.IGNORECASE)
+NESTED_CLOSING_TAGS_RE = re.compile(r"</body>\s*</html>\s*(?=<footer>|</body>)", re.IGNORECASE)
+TRAILING_CLOSING_TAGS_RE = re.compile(r"</body>\s*</html>.*$", re.IGNORECASE)
+
+def refresh_footer_links(fname, links_html):
+    """移除页面中已有的 footer 链接，并在页面底部写入新的 footer。返回错误信息，成功时返回 None。"""
     try:
         with open(fname, "r", encoding="utf-8", errors="replace") as f:
             content = f.read()
 
         # 使用正则表达式移除所有已有的 footer 链接部分
-        # re.DOTALL 允许 '.' 匹配换行符，re.IGNORECASE 忽略大小写
         # 正则表达式匹配从 <footer> 到 </footer> 之间的所有内容（非贪婪匹配）
-        content = re.sub(r"<footer>.*?</footer>", "", content, flags=re.DOTALL | re.IGNORECASE)
+        content = FOOTER_RE.sub("", content)
         
         # 清理可能存在的多余的HTML结构（处理嵌套的HTML问题）
-        content = re.sub(r"</body>\s*</html>\s*(?=<footer>|</body>)", "", content, flags=re.IGNORECASE)
-        
-        # 从潜在链接列表中排除当前文件
-        other_files = [x for x in all_html_files if x != fname]
-        # 确定要添加的随机链接数量（4 到 6 个之间）
-        num_links = min(len(other_files), random.randint(4, 6))
-
-        if num_links > 0:
-            random_links = random.sample(other_files, num_links)
-            links_html = "<footer><ul>\n" + "\n".join([f'<li><a href="{x}">{x}</a></li>' for x in random_links]) + "\n</ul></footer>"
-            
+        content = NESTED_CLOSING_TAGS_RE.sub("", content)
+
+        if links_html:
             # 确保只保留最后一个</body></html>标签
-            content = re.sub(r"</body>\s*</html>.*$", "", content, flags=re.IGNORECASE)
+            content = TRAILING_CLOSING_TAGS_RE.sub("", content)
             content = content.strip() + "\n" + links_html + "</body></html>"
 
         with open(fname, "w", encoding="utf-8") as f:
             f.write(content)
     except Exception as e:
-        print(f"无法为 {fname} 处理内部链接: {e}")
+        return f"无法为 {fname} 处理内部链接: {e}"
+    return None
+
+# 生成站点地图之后页面集合没有变化，直接复用同一份目录扫描结果
+all_html_files = existing_html_files
+# 每个页面对应的 <li> 链接片段只生成一次，各页面的 footer 直接拼接复用
+link_items = {x: LINK_ITEM_TEMPLATE.format(x) for x in all_html_files}
+
+# 只打乱一次所有页面，再用循环游标依次为每个页面分配链接（跳过页面自身），
+# 总开销为 O(N·k)，同时每个页面被链接的次数也更均匀
+link_pool = list(all_html_files)
+random.shuffle(link_pool)
+cursor = 0
+
+footer_jobs = []
+for fname in all_html_files:
+    # 确定要添加的随机链接数量（4 到 6 个之间），当前文件本身不计入
+    num_links = min(len(all_html_files) - 1, random.randint(4, 6))
+
+    links_html = None
+    if num_links > 0:
+        # 连续的 num_links + 1 个位置互不相同，因此链接不会重复
+        random_links = []
+        while len(random_links) < num_links:
+            candidate = link_pool[cursor % len(link_pool)]
+            cursor += 1
+            if candidate != fname:
+                random_links.append(candidate)
+        links_html = "<footer><ul>\n" + "\n".join(link_items[x] for x in random_links) + "\n</ul></footer>"
+    footer_jobs.append((fname, links_html))
+
+for fname, links_html in footer_jobs:
+    error = refresh_footer_links(fname, links_html)
+    if error:
+        print(error)
 
 print("✅ 已为所有页面更新底部随机内部链接 (每个 4-6 个，完全刷新)")
 